@@ -0,0 +1,511 @@
+from datetime import datetime
+from itertools import islice
+import json
+import os
+import shutil
+import threading
+import numpy as np
+from flask import current_app
+
+from app import db
+
+MANIFEST_FILE = 'manifest.json'
+SNAPSHOT_FORMAT = 2  # Snapshots written in another format are rebuilt on the next export
+BATCH_SIZE = 10000
+MAX_CHUNKS = 16  # Chunks per table before they are merged into one
+MISSING = -1  # Stored for NULL scores and ages
+MIN_CELL_SIZE = 5  # Cells describing fewer distinct users are suppressed
+
+# Upper bounds (exclusive) of each severity band and their labels
+GAD7_BANDS = ([5, 10, 15], ['minimal', 'mild', 'moderate', 'severe'])
+PHQ9_BANDS = ([5, 10, 15, 20], ['minimal', 'mild', 'moderate', 'moderately severe', 'severe'])
+AGE_BANDS = ([18, 25, 35, 45, 55, 65], ['<18', '18-24', '25-34', '35-44', '45-54', '55-64', '65+'])
+PERCENTILES = [10, 25, 50, 75, 90]
+# Inclusive ranges of the integer columns; anything else is exported as MISSING
+VALID_RANGES = {'gad7_score': (0, 21), 'phq9_score': (0, 27), 'age': (0, 130)}
+
+
+# Snapshot export
+
+def _read_manifest(snapshot_dir):
+    """Returns the snapshot manifest, or an empty one if no snapshot exists yet."""
+    path = os.path.join(snapshot_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(snapshot_dir, manifest):
+    """Atomically replaces the manifest so readers never see a partially written snapshot."""
+    path = os.path.join(snapshot_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def _save_columns(directory, columns):
+    """Writes each column as a .npy file in the given directory."""
+    os.makedirs(directory, exist_ok=True)
+    for name, values in columns.items():
+        np.save(os.path.join(directory, f'{name}.npy'), values)
+
+
+def _load_columns(directory, names):
+    """Memory-maps the given .npy columns from a directory."""
+    return {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r') for name in names}
+
+
+def _next_name(names):
+    """Returns the next zero-padded directory name after the given ones."""
+    return f'{max((int(name) for name in names), default=0) + 1:06d}'
+
+
+def _to_int(value, valid_range):
+    """Returns a stored value as an int, or MISSING if it is NULL, not an integer or out of range."""
+    if isinstance(value, str):
+        value = value.strip()
+        number = int(value) if value.lstrip('-').isdecimal() else None
+    elif isinstance(value, (int, float)) and not isinstance(value, bool) and float(value).is_integer():
+        number = int(value)
+    else:
+        number = None
+    if number is None or (valid_range and not valid_range[0] <= number <= valid_range[1]):
+        return MISSING
+    return number
+
+
+def _to_columns(rows, dtypes):
+    """
+    Converts fetched rows into NumPy column arrays, mapping NULLs to MISSING or ''.
+
+    The routes store scores and ages unvalidated, so values that are not integers or
+    fall outside VALID_RANGES are exported as MISSING (and logged) instead of failing
+    the export.
+    """
+    columns = {}
+    for index, (name, dtype) in enumerate(dtypes.items()):
+        values = [row[index] for row in rows]
+        if dtype.startswith('U'):
+            columns[name] = np.array([value or '' for value in values], dtype=dtype)
+        elif dtype.startswith('datetime64'):
+            columns[name] = np.array(values, dtype=dtype)
+        else:
+            converted = [_to_int(value, VALID_RANGES.get(name)) for value in values]
+            dropped = sum(1 for value, number in zip(values, converted) if value is not None and number == MISSING)
+            if dropped:
+                current_app.logger.warning('Exported %d invalid %s values as missing', dropped, name)
+            columns[name] = np.array(converted, dtype=dtype)
+    return columns
+
+
+SNAPSHOT_TABLES = {
+    'assessment': {
+        'model': 'Assessment',
+        'dtypes': {'user_id': 'int64', 'gad7_score': 'int16', 'phq9_score': 'int16', 'created_at': 'datetime64[s]'},
+    },
+    'mood_log': {
+        'model': 'MoodLog',
+        'dtypes': {'user_id': 'int64', 'mood': 'U50', 'created_at': 'datetime64[s]'},
+    },
+}
+USER_DTYPES = {'id': 'int64', 'age': 'int16', 'gender': 'U10'}
+
+
+def _export_table(snapshot_dir, manifest, table, model, dtypes):
+    """
+    Appends rows past each shard's primary key watermark, one chunk per BATCH_SIZE rows.
+
+    The manifest is rewritten after every chunk, so an interrupted export resumes
+    from the last completed chunk.
+    """
+    from shards import get_shard_router
+
+    state = manifest.setdefault(table, {'watermarks': {}, 'chunks': []})
+    exported = 0
+    for source, session in get_shard_router().all_sessions().items():
+        watermark = state['watermarks'].get(source, 0)
+        # The id is fetched last so it does not shift the exported columns
+        query = session.query(*[getattr(model, column) for column in dtypes], model.id).filter(model.id > watermark)
+        rows = iter(query.order_by(model.id.asc()).yield_per(BATCH_SIZE))
+        while True:
+            batch = list(islice(rows, BATCH_SIZE))
+            if not batch:
+                break
+            chunk = _next_name(state['chunks'])
+            _save_columns(os.path.join(snapshot_dir, table, chunk), _to_columns(batch, dtypes))
+            state['chunks'].append(chunk)
+            state['watermarks'][source] = batch[-1][-1]
+            _write_manifest(snapshot_dir, manifest)
+            exported += len(batch)
+    return exported
+
+
+def _compact_table(snapshot_dir, manifest, table, dtypes):
+    """Merges a table's chunks into one once there are more than MAX_CHUNKS, one column at a time."""
+    chunks = manifest[table]['chunks']
+    if len(chunks) <= MAX_CHUNKS:
+        return
+
+    merged = _next_name(chunks)
+    merged_dir = os.path.join(snapshot_dir, table, merged)
+    os.makedirs(merged_dir, exist_ok=True)
+    for column in dtypes:
+        parts = [np.load(os.path.join(snapshot_dir, table, chunk, f'{column}.npy'), mmap_mode='r') for chunk in chunks]
+        np.save(os.path.join(merged_dir, f'{column}.npy'), np.concatenate(parts))
+
+    manifest[table]['chunks'] = [merged]
+    _write_manifest(snapshot_dir, manifest)
+    for chunk in chunks:
+        shutil.rmtree(os.path.join(snapshot_dir, table, chunk), ignore_errors=True)
+
+
+def _export_users(snapshot_dir, manifest):
+    """Writes a new version of the User columns, sorted by id, and switches the manifest to it."""
+    import models
+
+    batches = []
+    query = db.session.query(models.User.id, models.User.age, models.User.gender).yield_per(BATCH_SIZE)
+    rows = iter(query)
+    while True:
+        batch = list(islice(rows, BATCH_SIZE))
+        if not batch:
+            break
+        batches.append(_to_columns(batch, USER_DTYPES))
+
+    columns = {
+        name: np.concatenate([batch[name] for batch in batches]) if batches else np.empty(0, dtype=dtype)
+        for name, dtype in USER_DTYPES.items()
+    }
+    order = np.argsort(columns['id'])
+
+    previous = manifest.get('user', {}).get('version')
+    version = _next_name([previous] if previous else [])
+    _save_columns(os.path.join(snapshot_dir, 'user', version), {name: values[order] for name, values in columns.items()})
+    manifest['user'] = {'version': version, 'exported_at': datetime.utcnow().isoformat()}
+    _write_manifest(snapshot_dir, manifest)
+    if previous:
+        shutil.rmtree(os.path.join(snapshot_dir, 'user', previous), ignore_errors=True)
+    return len(order)
+
+
+def _clear_snapshot(snapshot_dir):
+    """Deletes the manifest and the table directories written by `export_snapshot`, and nothing else."""
+    # Without a manifest readers see no snapshot, so the directories can go afterwards
+    for name in (MANIFEST_FILE, MANIFEST_FILE + '.tmp'):
+        path = os.path.join(snapshot_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+    for table in [*SNAPSHOT_TABLES, 'user']:
+        shutil.rmtree(os.path.join(snapshot_dir, table), ignore_errors=True)
+
+
+def export_snapshot(snapshot_dir, rebuild=False):
+    """
+    Appends Assessment and MoodLog rows added since the last export to the snapshot.
+
+    Rows are picked up per shard by primary key, written as .npy column chunks of at
+    most BATCH_SIZE rows, and merged once a table has more than MAX_CHUNKS chunks.
+    The small User table is rewritten in full, since age and gender change in place.
+
+    Moving a user between shards gives their rows new ids, so run with `rebuild`
+    after rebalancing to avoid counting those rows twice.
+
+    Args:
+        snapshot_dir (str): Directory holding the snapshot.
+        rebuild (bool): Discard the existing snapshot and export everything again.
+
+    Returns:
+        dict: Number of rows exported per table.
+    """
+    import models
+
+    manifest = _read_manifest(snapshot_dir)
+    if rebuild or (manifest and manifest.get('format') != SNAPSHOT_FORMAT):
+        _clear_snapshot(snapshot_dir)
+        manifest = {}
+    os.makedirs(snapshot_dir, exist_ok=True)
+    manifest['format'] = SNAPSHOT_FORMAT
+    exported = {}
+
+    for table, spec in SNAPSHOT_TABLES.items():
+        model = getattr(models, spec['model'])
+        exported[table] = _export_table(snapshot_dir, manifest, table, model, spec['dtypes'])
+        _compact_table(snapshot_dir, manifest, table, spec['dtypes'])
+
+    exported['user'] = _export_users(snapshot_dir, manifest)
+    return exported
+
+
+def load_snapshot(snapshot_dir):
+    """
+    Loads the snapshot as column arrays.
+
+    A table stored in a single chunk is returned as memory-mapped arrays; tables with
+    several chunks are concatenated into memory.
+
+    Args:
+        snapshot_dir (str): Directory holding the snapshot.
+
+    Returns:
+        dict: Table name mapped to a dict of column name to NumPy array.
+
+    Raises:
+        FileNotFoundError: If no snapshot has been exported yet.
+    """
+    manifest = _read_manifest(snapshot_dir)
+    if 'user' not in manifest or manifest.get('format') != SNAPSHOT_FORMAT:
+        raise FileNotFoundError(f'No analytics snapshot found in {snapshot_dir}')
+
+    tables = {}
+    for table, spec in SNAPSHOT_TABLES.items():
+        chunks = manifest.get(table, {}).get('chunks', [])
+        parts = [_load_columns(os.path.join(snapshot_dir, table, chunk), spec['dtypes']) for chunk in chunks]
+        tables[table] = {}
+        for column, dtype in spec['dtypes'].items():
+            if not parts:
+                tables[table][column] = np.empty(0, dtype=dtype)
+            elif len(parts) == 1:
+                tables[table][column] = parts[0][column]
+            else:
+                tables[table][column] = np.concatenate([part[column] for part in parts])
+
+    tables['user'] = _load_columns(os.path.join(snapshot_dir, 'user', manifest['user']['version']), USER_DTYPES)
+    return tables
+
+
+# Vectorized statistics
+
+def band_labels(values, bands):
+    """Maps scores (or ages) to band labels; MISSING values map to 'unknown'."""
+    edges, labels = bands
+    labeled = np.array(labels, dtype=object)[np.digitize(values, edges)]
+    labeled[values == MISSING] = 'unknown'
+    return labeled
+
+
+def join_users(user_ids, users):
+    """Returns the age band and gender of each user_id, joined from the sorted user columns."""
+    positions = np.searchsorted(users['id'], user_ids)
+    positions = np.clip(positions, 0, max(len(users['id']) - 1, 0))
+    if len(users['id']):
+        found = users['id'][positions] == user_ids
+        ages = np.where(found, users['age'][positions], MISSING)
+        genders = np.where(found, users['gender'][positions], '')
+    else:
+        ages = np.full(len(user_ids), MISSING)
+        genders = np.full(len(user_ids), '')
+    genders = np.where(genders == '', 'unknown', genders).astype(object)
+    return band_labels(ages, AGE_BANDS), genders
+
+
+def latest_per_user(user_ids, created_at):
+    """Returns indices of each user's most recent row."""
+    order = np.lexsort((created_at, user_ids))
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = user_ids[order][1:] != user_ids[order][:-1]
+    return order[last]
+
+
+def distinct_users_per_code(codes, user_ids, size):
+    """Returns, for each code in 0..size-1, the number of distinct users with that code."""
+    if not len(codes):
+        return np.zeros(size, dtype=np.int64)
+    width = int(user_ids.max()) + 1
+    pairs = np.unique(codes.astype(np.int64) * width + user_ids)
+    return np.bincount(pairs // width, minlength=size)
+
+
+def complementary_suppression(counts, primary):
+    """
+    Extends a suppression mask so no hidden cell can be recovered by subtraction.
+
+    Every row and column total of `counts` is treated as published, so a row or column
+    with exactly one hidden cell gets its smallest visible nonzero cell hidden as well,
+    repeated until no such line remains. Zero cells are never hidden.
+
+    Args:
+        counts (np.ndarray): 2-D table of counts.
+        primary (np.ndarray): Boolean mask of the cells that are too small to publish.
+
+    Returns:
+        np.ndarray: Boolean mask of the cells to hide.
+    """
+    hidden = primary & (counts > 0)
+    changed = True
+    while changed:
+        changed = False
+        # Rows of the transposed views are columns; assigning to them updates `hidden`
+        for lines, line_counts in ((hidden, counts), (hidden.T, counts.T)):
+            for line, line_count in zip(lines, line_counts):
+                if line.sum() != 1:
+                    continue
+                candidates = np.flatnonzero(~line & (line_count > 0))
+                if len(candidates):
+                    line[candidates[np.argmin(line_count[candidates])]] = True
+                    changed = True
+    return hidden
+
+
+def percentiles(scores, groups=None, min_cell_size=MIN_CELL_SIZE):
+    """
+    Returns score percentiles overall and, if groups are given, per group.
+
+    Expects one score per user; MISSING scores are ignored. Groups with fewer than
+    `min_cell_size` users are reported as suppressed, and so is the next smallest group
+    when the size of a single suppressed group would follow from the published counts.
+    """
+    valid = scores != MISSING
+    scores = scores[valid]
+    names = np.unique(groups[valid]) if groups is not None else []
+    members = [groups[valid] == name for name in names]
+    # The overall count is the sum of the group counts, so they form one line
+    sizes = np.array([[len(scores)] + [int(mask.sum()) for mask in members]])
+    hidden = complementary_suppression(sizes, sizes < min_cell_size)[0]
+
+    result = {'all': _percentile_summary(scores, hidden[0])}
+    for name, mask, suppressed in zip(names, members, hidden[1:]):
+        result[str(name)] = _percentile_summary(scores[mask], suppressed)
+    return result
+
+
+def _percentile_summary(scores, suppressed):
+    """Returns the count and PERCENTILES of a score array, or a suppression marker."""
+    if suppressed or not len(scores):
+        return {'suppressed': True}
+    values = np.percentile(scores, PERCENTILES)
+    return {'count': int(len(scores)), **{f'p{p}': float(v) for p, v in zip(PERCENTILES, values)}}
+
+
+def band_transitions(user_ids, created_at, scores, bands, min_cell_size=MIN_CELL_SIZE):
+    """
+    Counts moves between severity bands across each user's consecutive assessments.
+
+    Returns:
+        dict: {'bands': labels, 'counts': matrix} where counts[i][j] is the number of
+        transitions from band i to band j, or None when fewer than `min_cell_size`
+        users made that transition.
+    """
+    edges, labels = bands
+    valid = scores != MISSING
+    user_ids, created_at, scores = user_ids[valid], created_at[valid], scores[valid]
+
+    order = np.lexsort((created_at, user_ids))
+    sorted_users = user_ids[order]
+    band = np.digitize(scores[order], edges)
+    same_user = sorted_users[1:] == sorted_users[:-1]
+
+    size = len(labels)
+    cells = band[:-1][same_user] * size + band[1:][same_user]
+    counts = np.bincount(cells, minlength=size * size)
+    people = distinct_users_per_code(cells, sorted_users[1:][same_user], size * size)
+    matrix = [int(count) if count == 0 or users >= min_cell_size else None for count, users in zip(counts, people)]
+    return {'bands': labels, 'counts': [matrix[row * size:(row + 1) * size] for row in range(size)]}
+
+
+def value_counts(values, user_ids, groups=None, min_cell_size=MIN_CELL_SIZE):
+    """
+    Returns value frequencies overall and, if groups are given, per group.
+
+    A frequency is None when fewer than `min_cell_size` distinct users contribute to
+    it, or when it is hidden by `complementary_suppression` so that a suppressed
+    frequency cannot be worked out from the group totals and the overall frequencies.
+    """
+    unique, codes = np.unique(values, return_inverse=True)
+    names, group_codes = np.unique(groups, return_inverse=True) if groups is not None else ([], None)
+    size = len(unique)
+
+    # Row 0 holds the overall frequencies, which are the column totals of the group rows
+    counts = np.zeros((len(names) + 1, size), dtype=np.int64)
+    people = np.zeros_like(counts)
+    counts[0] = np.bincount(codes, minlength=size)
+    people[0] = distinct_users_per_code(codes, user_ids, size)
+    if len(names):
+        cells = group_codes * size + codes
+        counts[1:] = np.bincount(cells, minlength=len(names) * size).reshape(len(names), size)
+        people[1:] = distinct_users_per_code(cells, user_ids, len(names) * size).reshape(len(names), size)
+    hidden = complementary_suppression(counts, people < min_cell_size)
+
+    def row(index):
+        return {str(value): None if hidden[index, column] else int(counts[index, column])
+                for column, value in enumerate(unique) if counts[index, column]}
+
+    result = {'all': row(0)}
+    for index, name in enumerate(names, start=1):
+        result[str(name)] = row(index)
+    return result
+
+
+def compute_report(tables, min_cell_size=MIN_CELL_SIZE):
+    """
+    Computes the cohort report from a loaded snapshot.
+
+    GAD-7/PHQ-9 percentiles and severity bands use each user's latest answered score;
+    transitions use every pair of consecutive answered scores. Any group or cell
+    describing fewer than `min_cell_size` distinct users is suppressed, along with the
+    cells needed to keep it from being derived from published totals. Transition
+    matrices publish no totals, so only their small cells are suppressed.
+
+    Args:
+        tables (dict): Snapshot as returned by `load_snapshot`.
+        min_cell_size (int): Smallest number of users a reported figure may describe.
+
+    Returns:
+        dict: JSON-serializable report.
+    """
+    users = tables['user']
+    assessments = tables['assessment']
+    moods = tables['mood_log']
+
+    report = {'users': int(len(users['id'])), 'assessments': int(len(assessments['user_id'])),
+              'mood_logs': int(len(moods['user_id'])), 'min_cell_size': min_cell_size}
+    for name, bands in (('gad7_score', GAD7_BANDS), ('phq9_score', PHQ9_BANDS)):
+        scores = np.asarray(assessments[name])
+        # Latest assessment per user that actually includes this score
+        answered = np.flatnonzero(scores != MISSING)
+        latest = answered[latest_per_user(assessments['user_id'][answered], assessments['created_at'][answered])]
+        latest_scores = scores[latest]
+        latest_users = np.asarray(assessments['user_id'][latest])
+        age_bands, genders = join_users(latest_users, users)
+        severity = band_labels(latest_scores, bands)
+        report[name] = {
+            'percentiles_by_age': percentiles(latest_scores, age_bands, min_cell_size),
+            'percentiles_by_gender': percentiles(latest_scores, genders, min_cell_size),
+            'severity_by_age': value_counts(severity, latest_users, age_bands, min_cell_size),
+            'severity_by_gender': value_counts(severity, latest_users, genders, min_cell_size),
+            'transitions': band_transitions(assessments['user_id'], assessments['created_at'], scores, bands, min_cell_size),
+        }
+
+    mood_users = np.asarray(moods['user_id'])
+    mood_age_bands, mood_genders = join_users(mood_users, users)
+    report['moods'] = {
+        'by_age': value_counts(np.asarray(moods['mood']), mood_users, mood_age_bands, min_cell_size),
+        'by_gender': value_counts(np.asarray(moods['mood']), mood_users, mood_genders, min_cell_size),
+    }
+    return report
+
+
+_report_cache = {}
+_report_cache_lock = threading.Lock()
+
+
+def get_report(snapshot_dir, min_cell_size=MIN_CELL_SIZE):
+    """
+    Returns the cohort report for a snapshot, recomputing it only after the snapshot changes.
+
+    Raises:
+        FileNotFoundError: If no snapshot has been exported yet.
+    """
+    manifest_path = os.path.join(snapshot_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(f'No analytics snapshot found in {snapshot_dir}')
+
+    key = (os.path.abspath(snapshot_dir), os.stat(manifest_path).st_mtime_ns, min_cell_size)
+    with _report_cache_lock:
+        if _report_cache.get('key') == key:
+            return _report_cache['report']
+
+    report = compute_report(load_snapshot(snapshot_dir), min_cell_size)
+    with _report_cache_lock:
+        _report_cache.update(key=key, report=report)
+    return report
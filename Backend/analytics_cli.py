@@ -0,0 +1,34 @@
+from flask import current_app
+from flask.cli import AppGroup
+import click
+import json
+
+# Kept apart from analytics.py so registering the commands does not import NumPy
+analytics_cli = AppGroup('analytics', help='Export snapshots and compute cohort statistics.')
+
+
+def get_snapshot_dir():
+    """Returns the configured snapshot directory for the current app."""
+    return current_app.config['ANALYTICS_SNAPSHOT_DIR']
+
+
+@analytics_cli.command('snapshot')
+@click.option('--rebuild', is_flag=True, help='Discard the snapshot and export everything again (run after moving users).')
+def snapshot_command(rebuild):
+    """Exports rows added since the last snapshot."""
+    from analytics import export_snapshot
+
+    exported = export_snapshot(get_snapshot_dir(), rebuild=rebuild)
+    click.echo(', '.join(f'{table}: {count} rows' for table, count in exported.items()))
+
+
+@analytics_cli.command('report')
+def report_command():
+    """Prints the cohort report computed from the snapshot as JSON."""
+    from analytics import get_report
+
+    try:
+        report = get_report(get_snapshot_dir(), current_app.config['ANALYTICS_MIN_CELL_SIZE'])
+    except FileNotFoundError as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps(report, indent=2))
@@ -1,43 +1,201 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flask_cors import CORS
-from flask_socketio import SocketIO, emit
-from flask_migrate import Migrate
+import ast
 import os
 import logging
 
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
 # Initialize extensions
 db = SQLAlchemy()
-socketio = SocketIO()  # Initialize SocketIO globally
-migrate = Migrate()  # Initialize Flask-Migrate
+
+def env_flag(name, default):
+    """Returns a boolean environment setting, accepting 1/true/yes as true."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes')
+
+def migration_heads(migrations_dir):
+    """
+    Returns the head revisions of the migration scripts.
+
+    The `revision` and `down_revision` assignments are read with `ast` rather than by
+    loading the scripts through Alembic, whose import alone costs more than the rest of
+    a production boot.
+
+    Args:
+        migrations_dir (str): The Flask-Migrate directory holding `versions/`.
+
+    Returns:
+        set: Revisions that no other revision builds on.
+    """
+    revisions, parents = set(), set()
+    versions_dir = os.path.join(migrations_dir, 'versions')
+    for name in os.listdir(versions_dir):
+        if not name.endswith('.py'):
+            continue
+        with open(os.path.join(versions_dir, name)) as f:
+            tree = ast.parse(f.read())
+        values = {}
+        for node in tree.body:
+            # Newer Alembic templates annotate these assignments
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target] if isinstance(node, ast.AnnAssign) else []
+            for target in targets:
+                if isinstance(target, ast.Name) and target.id in ('revision', 'down_revision'):
+                    values[target.id] = ast.literal_eval(node.value)
+        if 'revision' not in values:
+            continue
+        revisions.add(values['revision'])
+        down_revision = values.get('down_revision')
+        if isinstance(down_revision, str):
+            parents.add(down_revision)
+        elif down_revision:
+            parents.update(down_revision)  # Merge revisions have several parents
+    return revisions - parents
+
+def check_schema_revision(app):
+    """
+    Verifies that the database is at the latest Alembic revision.
+
+    Used instead of `db.create_all()` in production boot mode, where the schema is
+    managed by `flask db upgrade` and only a single revision lookup is needed.
+
+    Args:
+        app (Flask): The application whose database should be checked.
+
+    Raises:
+        RuntimeError: If the database revision does not match the migration head.
+    """
+    from sqlalchemy import inspect, text
+
+    expected_heads = migration_heads(app.config['MIGRATIONS_DIR'])
+
+    with app.app_context():
+        with db.engine.connect() as connection:
+            current_heads = set()
+            if inspect(connection).has_table('alembic_version'):
+                current_heads = {row[0] for row in connection.execute(text('SELECT version_num FROM alembic_version'))}
+        # Drop pooled connections so forked workers never share the parent's sockets
+        db.engine.dispose()
+
+    if current_heads != expected_heads:
+        raise RuntimeError(
+            f"Database revision {sorted(current_heads)} does not match migration head "
+            f"{sorted(expected_heads)}; run `ENABLE_MIGRATE=1 flask db upgrade` before starting the app"
+        )
+
+def init_extensions(app):
+    """
+    Attaches the Flask extensions to the app.
+
+    Only Flask-SQLAlchemy is always loaded. Flask-CORS, Flask-SocketIO and Flask-Migrate
+    (with Alembic) are imported only when CORS_ORIGINS, ENABLE_SOCKETIO and
+    ENABLE_MIGRATE ask for them, so workers that do not need them never pay for them.
+    SocketIO wraps the WSGI app and CORS registers request hooks, so neither can be
+    attached after the first request; they are switched off rather than deferred.
+
+    Args:
+        app (Flask): The application to initialize extensions for.
+    """
+    db.init_app(app)
+
+    if app.config['CORS_ORIGINS']:
+        from flask_cors import CORS
+        # Enable Cross-Origin Resource Sharing (CORS) for frontend communication
+        CORS(app, resources={r"/api/*": {"origins": app.config['CORS_ORIGINS']}})
+
+    if app.config['ENABLE_SOCKETIO']:
+        from sockets import socketio
+        # An explicit async mode skips SocketIO probing for eventlet/gevent on every boot
+        socketio.init_app(app, async_mode=app.config['SOCKETIO_ASYNC_MODE'])  # Attach SocketIO to the app
+
+    if app.config['ENABLE_MIGRATE']:
+        from flask_migrate import Migrate
+        Migrate(app, db, directory=app.config['MIGRATIONS_DIR'])  # Attach Flask-Migrate to the app and database
 
 def create_app():
     """
     Factory function to create and configure the Flask application.
 
+    In production boot mode (BOOT_MODE=production) the factory checks the Alembic
+    revision instead of calling `db.create_all()` and leaves no open database
+    connections behind, so it is safe to call once in a preforking master
+    (e.g. `gunicorn --preload "app:create_app()"`). A deploy runs, in order:
+
+        BOOT_MODE=production ENABLE_MIGRATE=1 flask --app app:create_app db upgrade
+        BOOT_MODE=production ENABLE_MIGRATE=1 flask --app app:create_app shards create-tables
+        BOOT_MODE=production ENABLE_MIGRATE=1 flask --app app:create_app shards import-default
+        BOOT_MODE=production gunicorn --preload "app:create_app()"
+
+    The two `shards` steps apply only when SHARD_URIS is set, and `import-default`
+    only when sharding is first switched on. With ENABLE_MIGRATE set the schema checks
+    are skipped, since that process is the one bringing the schema up to date.
+
+    Alembic migrates the default database only. The production boot also checks that
+    every shard has the per-user tables and columns of the models, but a column
+    added to a per-user model must be added to each shard by hand.
+
+    SocketIO and CORS stay on by default. Workers that serve only the REST API behind
+    a proxy that adds the CORS headers boot fastest with both switched off:
+
+        BOOT_MODE=production ENABLE_SOCKETIO=0 CORS_ORIGINS= gunicorn --preload "app:create_app()"
+
     Returns:
         Flask app instance.
     """
     app = Flask(__name__)
-    # Enable Cross-Origin Resource Sharing (CORS) for frontend communication
-    CORS(app, resources={r"/api/*": {"origins": "http://localhost:3000"}})
 
     # Configuration
     app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URI', 'sqlite:///database.db')  # Default to SQLite
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # The memory backend is per process, so it is only the default for a single worker
+    single_process = int(os.getenv('WEB_CONCURRENCY', 1)) <= 1
+    app.config['IDEMPOTENCY_BACKEND'] = os.getenv('IDEMPOTENCY_BACKEND', 'memory' if single_process else 'database')
+    app.config['IDEMPOTENCY_TTL'] = int(os.getenv('IDEMPOTENCY_TTL', 24 * 60 * 60))  # Seconds a stored response is replayed
+    app.config['IDEMPOTENCY_MAX_KEYS'] = int(os.getenv('IDEMPOTENCY_MAX_KEYS', 10000))  # Memory backend only
+    app.config['IDEMPOTENCY_LOCK_TIMEOUT'] = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', 60))  # Seconds before an unfinished request's key can be reused
+    app.config['IDEMPOTENCY_PRUNE_INTERVAL'] = int(os.getenv('IDEMPOTENCY_PRUNE_INTERVAL', 300))  # Database backend only; 0 leaves pruning to the CLI
+    app.config['BOOT_MODE'] = os.getenv('BOOT_MODE', 'development')  # 'development' or 'production'
+    app.config['MIGRATIONS_DIR'] = os.getenv('MIGRATIONS_DIR', os.path.join(BACKEND_DIR, 'migrations'))
+    app.config['SOCKETIO_ASYNC_MODE'] = os.getenv('SOCKETIO_ASYNC_MODE')  # None lets SocketIO detect it
+    # Per-user tables are spread over these databases; empty keeps everything in SQLALCHEMY_DATABASE_URI
+    app.config['SHARD_URIS'] = [uri.strip() for uri in os.getenv('SHARD_URIS', '').split(',') if uri.strip()]
+    app.config['SHARD_STRATEGY'] = os.getenv('SHARD_STRATEGY', 'hash')  # 'hash' or 'directory'
+    app.config['SQLALCHEMY_BINDS'] = {f'shard_{i}': uri for i, uri in enumerate(app.config['SHARD_URIS'])}
+    # Relative paths are anchored to the backend so the CLI and the server share one snapshot
+    app.config['ANALYTICS_SNAPSHOT_DIR'] = os.path.join(BACKEND_DIR, os.getenv('ANALYTICS_SNAPSHOT_DIR', 'analytics_snapshot'))
+    app.config['ANALYTICS_MIN_CELL_SIZE'] = int(os.getenv('ANALYTICS_MIN_CELL_SIZE', 5))  # Smallest group a report may describe
+    app.config['ADMIN_TOKEN'] = os.getenv('ADMIN_TOKEN')  # Required by /api/admin/* routes; unset disables them
+    app.config['CORS_ORIGINS'] = os.getenv('CORS_ORIGINS', 'http://localhost:3000')  # Empty disables CORS
+    app.config['ENABLE_SOCKETIO'] = env_flag('ENABLE_SOCKETIO', True)
+    production = app.config['BOOT_MODE'] == 'production'
+    # Migrations are always available in development; in production only when explicitly enabled
+    app.config['ENABLE_MIGRATE'] = env_flag('ENABLE_MIGRATE', not production)
 
     # Logging configuration
-    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s: %(message)s')
+    logging.basicConfig(level=logging.INFO if production else logging.DEBUG, format='%(asctime)s %(levelname)s: %(message)s')
 
     # Initialize extensions
-    db.init_app(app)
-    socketio.init_app(app)  # Attach SocketIO to the app
-    migrate.init_app(app, db)  # Attach Flask-Migrate to the app and database
+    init_extensions(app)
 
     # Register blueprints for modular routing
     from routes import auth
     app.register_blueprint(auth, url_prefix='/api')  # Add a prefix for API routes
 
+    # Expose `flask idempotency prune` for the database backend
+    from idempotency import idempotency_cli
+    app.cli.add_command(idempotency_cli)
+
+    # Route per-user tables to their shard and expose the rebalancing commands
+    from shards import shards_cli, remove_shard_sessions, get_shard_router
+    app.teardown_appcontext(remove_shard_sessions)
+    app.cli.add_command(shards_cli)
+
+    # The analytics commands import NumPy only when they run
+    from analytics_cli import analytics_cli
+    app.cli.add_command(analytics_cli)
+
     # Error handlers
     @app.errorhandler(404)
     def not_found_error(error):
@@ -49,67 +207,30 @@ def create_app():
         """Handles 500 errors (internal server errors)."""
         return {"error": "An internal error occurred"}, 500
 
-    # Create database tables if they don't exist
-    with app.app_context():
-        db.create_all()
+    if production:
+        # A migration process is what fixes a stale revision, so it skips the check
+        if not app.config['ENABLE_MIGRATE']:
+            check_schema_revision(app)
+            with app.app_context():
+                if get_shard_router().enabled:
+                    get_shard_router().check_tables()
+    else:
+        # Create database tables if they don't exist
+        with app.app_context():
+            # Only the default database has model tables; the shard tables are created below
+            db.create_all(bind_key=None)
+            if get_shard_router().enabled:
+                get_shard_router().create_tables()
+                for problem in get_shard_router().schema_problems():
+                    app.logger.warning('Shard schema is out of date: %s', problem)
 
     return app
 
-# WebSocket event handlers
-@socketio.on('connect')
-def handle_connect():
-    """Handles WebSocket connection events."""
-    print("Client connected.")
-
-@socketio.on('disconnect')
-def handle_disconnect():
-    """Handles WebSocket disconnection events."""
-    print("Client disconnected.")
-
-@socketio.on('message')
-def handle_message(data):
-    """
-    Handles incoming WebSocket messages from the client.
-
-    Args:
-        data (dict): Incoming message data. Expected keys: "user_id", "message".
-    """
-    try:
-        user_id = data.get('user_id')
-        user_message = data.get('message')
-
-        # Validate input
-        if not user_id or not user_message:
-            emit('error', {'error': 'User ID and message are required'})
-            return
-
-        # Save user message to the database
-        user_chat = ChatHistory(user_id=user_id, message=user_message, sender='user', created_at=datetime.utcnow())
-        db.session.add(user_chat)
-        db.session.commit()
-
-        # Prepare LLM context
-        chat_history = ChatHistory.query.filter_by(user_id=user_id).order_by(ChatHistory.created_at.asc()).all()
-        chat_history_list = [{'sender': chat.sender, 'message': chat.message, 'timestamp': chat.created_at} for chat in chat_history]
-        context = prepare_context(chat_history_list, max_tokens=3000)
-
-        # Generate bot reply (placeholder logic)
-        bot_reply = f"Bot reply to: {user_message}"
-
-        # Save bot reply to the database
-        bot_chat = ChatHistory(user_id=user_id, message=bot_reply, sender='bot', created_at=datetime.utcnow())
-        db.session.add(bot_chat)
-        db.session.commit()
-
-        # Emit bot reply back to the frontend
-        emit('bot_reply', {'bot_reply': bot_reply})
-
-    except Exception as e:
-        # Handle unexpected errors
-        emit('error', {'error': 'An unexpected error occurred', 'details': str(e)})
-
 if __name__ == '__main__':
+    # Import the app module by name so routes and models share its `db`
+    import app as application
+    from sockets import socketio
+
     # Create the app and run it with SocketIO
-    app = create_app()
+    app = application.create_app()
     socketio.run(app, debug=True)  # Run the app in debug mode
-
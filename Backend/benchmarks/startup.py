@@ -0,0 +1,130 @@
+"""
+Startup-time benchmark for the backend.
+
+Measures, in fresh interpreter processes, the time to import the `app` module and the
+time from interpreter start to the first served request. Run from the Backend directory:
+
+    python benchmarks/startup.py --runs 10 --boot-mode production
+
+Both modes use a throwaway SQLite file unless DATABASE_URI is set; in production mode
+it is migrated with `flask db upgrade` before the runs. ENABLE_SOCKETIO and
+CORS_ORIGINS are passed through, so the fastest production setup is measured with:
+
+    ENABLE_SOCKETIO=0 CORS_ORIGINS= python benchmarks/startup.py --boot-mode production
+
+Each summary is appended to benchmarks/results.jsonl (see --output) together with
+the git revision and these settings, and the medians are compared with the previous
+result for the same boot mode and settings.
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_OUTPUT = os.path.join(BACKEND_DIR, 'benchmarks', 'results.jsonl')
+METRICS = ('import_s', 'create_app_s', 'first_request_s')
+SETTINGS = ('ENABLE_SOCKETIO', 'CORS_ORIGINS')  # Recorded with each result; unset means the app default
+
+# Executed in a child process so every run pays the full cold-start cost
+CHILD_SCRIPT = '''
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app()
+created = time.perf_counter()
+flask_app.test_client().get('/api/__startup_probe__')
+served = time.perf_counter()
+print(json.dumps({
+    'import_s': imported - start,
+    'create_app_s': created - imported,
+    'first_request_s': served - start,
+}))
+'''
+
+
+def run_once(env):
+    """Runs one cold start in a child process and returns its timings."""
+    result = subprocess.run(
+        [sys.executable, '-c', CHILD_SCRIPT],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def migrate_database(env):
+    """Brings the benchmark database up to the migration head."""
+    subprocess.run(
+        [sys.executable, '-m', 'flask', '--app', 'app:create_app', 'db', 'upgrade'],
+        cwd=BACKEND_DIR, env={**env, 'ENABLE_MIGRATE': '1'}, capture_output=True, check=True
+    )
+
+
+def git_revision():
+    """Returns the current git revision, or None outside a git checkout."""
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+
+def previous_result(output, boot_mode, settings):
+    """Returns the most recent recorded summary for a boot mode and settings, or None."""
+    if not os.path.exists(output):
+        return None
+    previous = None
+    with open(output) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('boot_mode') == boot_mode and record.get('settings', {}) == settings:
+                previous = record
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark backend import time and time to first request.')
+    parser.add_argument('--runs', type=int, default=10, help='Number of cold starts to measure')
+    parser.add_argument('--boot-mode', default='development', choices=['development', 'production'])
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='JSON lines file the summary is appended to')
+    parser.add_argument('--no-record', action='store_true', help='Print the summary without appending it to --output')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = dict(os.environ)
+        env['BOOT_MODE'] = args.boot_mode
+        env.setdefault('DATABASE_URI', f'sqlite:///{os.path.join(tmp_dir, "startup.db")}')
+        env.pop('ENABLE_MIGRATE', None)
+        if args.boot_mode == 'production':
+            migrate_database(env)
+
+        runs = [run_once(env) for _ in range(args.runs)]
+
+    summary = {
+        'recorded_at': datetime.datetime.utcnow().isoformat(),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'boot_mode': args.boot_mode,
+        'settings': {name: os.environ[name] for name in SETTINGS if name in os.environ},
+        'runs': args.runs,
+    }
+    for metric in METRICS:
+        values = [run[metric] for run in runs]
+        summary[metric] = {'median': statistics.median(values), 'min': min(values), 'max': max(values)}
+    print(json.dumps(summary, indent=2))
+
+    previous = previous_result(args.output, args.boot_mode, summary['settings'])
+    if previous:
+        for metric in METRICS:
+            before, after = previous[metric]['median'], summary[metric]['median']
+            print(f"{metric}: {before:.4f}s -> {after:.4f}s ({(after - before) / before:+.1%}) vs {previous['revision']}")
+
+    if not args.no_record:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(summary) + '\n')
+
+
+if __name__ == '__main__':
+    main()
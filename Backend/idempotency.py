@@ -0,0 +1,296 @@
+from flask import request, current_app, make_response, jsonify
+from flask.cli import AppGroup
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+import hashlib
+import json
+import threading
+import time
+import click
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+RETRY_AFTER_SECONDS = 1
+
+idempotency_cli = AppGroup('idempotency', help='Maintain stored idempotent responses.')
+
+
+class MemoryIdempotencyStore:
+    """
+    Bounded store for replayable responses that lives inside one process.
+
+    Only requests handled by the same worker process see each other's keys, so this
+    backend is only safe for a single-process server; preforked or multi-node
+    deployments need the database backend.
+
+    Entries expire `ttl` seconds after they were reserved. Once `max_keys` is reached,
+    expired entries are dropped first and then the oldest completed ones; a reservation
+    still in progress is never evicted. A reservation whose request has not finished
+    within `lock_timeout` seconds is treated as abandoned and can be taken over.
+    """
+
+    def __init__(self, ttl, max_keys, lock_timeout):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.lock_timeout = lock_timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def reserve(self, key, request_hash):
+        """
+        Marks a key as in progress.
+
+        Returns:
+            None if the caller now owns the key, otherwise the existing
+            (request_hash, status_code, body) entry; status_code is None while in progress.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                reserved_at, stored_hash, status_code, body = entry
+                expired = reserved_at + self.ttl <= now
+                abandoned = status_code is None and reserved_at + self.lock_timeout <= now
+                if not expired and not abandoned:
+                    return stored_hash, status_code, body
+                del self._entries[key]
+
+            self._entries[key] = (now, request_hash, None, None)
+            if len(self._entries) > self.max_keys:
+                self._evict(now)
+            return None
+
+    def _evict(self, now):
+        """Drops expired entries, then the oldest completed ones, until the store fits in `max_keys`."""
+        # Entries are kept in reservation order, so the expired ones are at the front
+        for key, (reserved_at, _, _, _) in list(self._entries.items()):
+            if reserved_at + self.ttl > now:
+                break
+            del self._entries[key]
+
+        for key, (_, _, status_code, _) in list(self._entries.items()):
+            if len(self._entries) <= self.max_keys:
+                break
+            if status_code is not None:
+                del self._entries[key]
+
+    def complete(self, key, status_code, body):
+        """Stores the finished response for a reserved key."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], entry[1], status_code, body)
+
+    def release(self, key):
+        """Drops an in-progress reservation so the request can be retried."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is None:
+                del self._entries[key]
+
+
+class DatabaseIdempotencyStore:
+    """
+    Store for replayable responses backed by the `idempotency_key` table, shared by all
+    worker processes and nodes.
+
+    The key's primary key constraint makes reservation atomic across processes.
+    Expired rows are pruned by `flask idempotency prune`, and by each worker at most
+    once every `prune_interval` seconds (0 disables pruning on the request path).
+    """
+
+    def __init__(self, ttl, lock_timeout, prune_interval):
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.prune_interval = prune_interval
+        self._next_prune = time.monotonic() + prune_interval
+        self._lock = threading.Lock()
+
+    def prune(self):
+        """
+        Deletes rows older than the TTL.
+
+        Returns:
+            int: Number of rows deleted.
+        """
+        from app import db
+        from models import IdempotencyKey
+
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        deleted = IdempotencyKey.query.filter(IdempotencyKey.created_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+    def _prune_due(self):
+        """Returns True for the one request per interval that should prune expired rows."""
+        if not self.prune_interval:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_prune:
+                return False
+            self._next_prune = now + self.prune_interval
+            return True
+
+    def reserve(self, key, request_hash):
+        """
+        Marks a key as in progress.
+
+        Returns:
+            None if the caller now owns the key, otherwise the existing
+            (request_hash, status_code, body) entry; status_code is None while in progress.
+        """
+        from app import db
+        from models import IdempotencyKey
+
+        if self._prune_due():
+            self.prune()
+
+        now = datetime.utcnow()
+        db.session.add(IdempotencyKey(key=key, request_hash=request_hash, created_at=now))
+        try:
+            db.session.commit()
+            return None
+        except IntegrityError:
+            db.session.rollback()
+
+        record = db.session.get(IdempotencyKey, key)
+        if record is None:
+            # The other reservation was released in the meantime; the client may retry
+            return request_hash, None, None
+
+        if record.status_code is None and record.created_at < now - timedelta(seconds=self.lock_timeout):
+            # Take over an abandoned reservation, unless another request just did
+            taken = IdempotencyKey.query.filter_by(key=key, created_at=record.created_at, status_code=None).update(
+                {'request_hash': request_hash, 'created_at': now}, synchronize_session=False)
+            db.session.commit()
+            if taken:
+                return None
+            db.session.refresh(record)
+
+        return record.request_hash, record.status_code, record.body
+
+    def complete(self, key, status_code, body):
+        """Stores the finished response for a reserved key."""
+        from app import db
+        from models import IdempotencyKey
+
+        IdempotencyKey.query.filter_by(key=key).update({'status_code': status_code, 'body': body}, synchronize_session=False)
+        db.session.commit()
+
+    def release(self, key):
+        """Drops an in-progress reservation so the request can be retried."""
+        from app import db
+        from models import IdempotencyKey
+
+        IdempotencyKey.query.filter_by(key=key, status_code=None).delete(synchronize_session=False)
+        db.session.commit()
+
+
+def get_idempotency_store():
+    """
+    Returns the idempotency store for the current app, creating it on first use.
+
+    The backend is chosen by the IDEMPOTENCY_BACKEND config value ('memory' or 'database').
+    """
+    store = current_app.extensions.get('idempotency')
+    if store is None:
+        ttl = current_app.config.get('IDEMPOTENCY_TTL', 24 * 60 * 60)
+        lock_timeout = current_app.config.get('IDEMPOTENCY_LOCK_TIMEOUT', 60)
+        if current_app.config.get('IDEMPOTENCY_BACKEND', 'memory') == 'database':
+            store = DatabaseIdempotencyStore(ttl, lock_timeout, current_app.config.get('IDEMPOTENCY_PRUNE_INTERVAL', 300))
+        else:
+            store = MemoryIdempotencyStore(ttl, current_app.config.get('IDEMPOTENCY_MAX_KEYS', 10000), lock_timeout)
+        current_app.extensions['idempotency'] = store
+    return store
+
+
+def hash_request():
+    """Returns a hash of the request body; JSON bodies are hashed in canonical form."""
+    data = request.get_json(silent=True)
+    if data is None:
+        payload = request.get_data()
+    else:
+        payload = json.dumps(data, sort_keys=True, separators=(',', ':')).encode()
+    return hashlib.sha256(payload).hexdigest()
+
+
+def idempotent(view):
+    """
+    Decorator that replays the stored response for a repeated `Idempotency-Key` header.
+
+    The key is reserved before the view runs. A duplicate that arrives while the first
+    request is still running gets 409 with a Retry-After header, and a key reused with
+    a different request body gets 422. Requests without the header are handled normally.
+    Server errors (5xx) are not stored, so a retry after a failure runs the view again.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not idempotency_key:
+            return view(*args, **kwargs)
+
+        if len(idempotency_key) > MAX_KEY_LENGTH:
+            return jsonify({'error': f'{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters'}), 400
+
+        from app import db
+
+        store = get_idempotency_store()
+        # Scope keys to the endpoint so the same key cannot replay another route's response
+        store_key = f'{request.path}:{idempotency_key}'
+        request_hash = hash_request()
+
+        try:
+            stored = store.reserve(store_key, request_hash)
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            return jsonify({'error': 'Database error', 'details': str(e)}), 500
+
+        if stored is not None:
+            stored_hash, status_code, body = stored
+            if stored_hash != request_hash:
+                return jsonify({'error': f'{IDEMPOTENCY_HEADER} was already used with a different request'}), 422
+            if status_code is None:
+                response = jsonify({'error': f'A request with this {IDEMPOTENCY_HEADER} is still being processed'})
+                response.status_code = 409
+                response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+                return response
+            response = current_app.response_class(body, status=status_code, mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            _finish(store, store_key, None)
+            raise
+        _finish(store, store_key, response)
+        return response
+
+    return wrapper
+
+
+def _finish(store, store_key, response):
+    """Stores the response for a reserved key, or releases the key after a server error."""
+    from app import db
+
+    try:
+        if response is None or response.status_code >= 500:
+            store.release(store_key)
+        else:
+            store.complete(store_key, response.status_code, response.get_data(as_text=True))
+    except SQLAlchemyError:
+        # The reservation expires after the lock timeout, so retries are only delayed
+        db.session.rollback()
+        current_app.logger.exception('Could not record idempotent response for %s', store_key)
+
+
+@idempotency_cli.command('prune')
+def prune_command():
+    """Deletes expired keys from the database backend; suited to a cron job."""
+    store = get_idempotency_store()
+    if not isinstance(store, DatabaseIdempotencyStore):
+        raise click.ClickException('Pruning applies to IDEMPOTENCY_BACKEND=database only')
+    click.echo(f'Deleted {store.prune()} expired idempotency keys')
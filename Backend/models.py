@@ -71,3 +71,28 @@ class JournalEntry(db.Model):
     def __repr__(self):
         return f'<JournalEntry for User {self.user_id}>'
 
+
+# Idempotency Key table
+class IdempotencyKey(db.Model):
+    """
+    Represents a reserved or stored POST response that is replayed for a repeated Idempotency-Key header.
+    """
+    key = db.Column(db.String(512), primary_key=True)  # Request path + client key
+    request_hash = db.Column(db.String(64), nullable=False)  # SHA-256 of the request body
+    status_code = db.Column(db.Integer, nullable=True)  # NULL while the request is in progress
+    body = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f'<IdempotencyKey {self.key}>'
+
+# User Shard directory table
+class UserShard(db.Model):
+    """
+    Records the shard holding a user's rows when it differs from the hash placement.
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    shard = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<UserShard User {self.user_id} on shard {self.shard}>'
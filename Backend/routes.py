@@ -1,13 +1,34 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy.exc import SQLAlchemyError
 from models import User, Assessment, ChatHistory, JournalEntry, MoodLog 
 from app import db
+from idempotency import idempotent
+from shards import get_user_session, rollback_sessions
 from datetime import datetime, timedelta
 import re  # Import the regex module
+import hmac
 
 auth = Blueprint('auth', __name__)
 
+def parse_user_id(value):
+    """
+    Converts a user ID from a request body to an int.
+
+    Args:
+        value: The raw `user_id` value (an int or a string of digits).
+
+    Returns:
+        int: The user ID, or None if the value is not a positive integer.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    if isinstance(value, int) and value > 0:
+        return value
+    return None
+
 # User signup route
 @auth.route('/auth/signup', methods=['POST'])
 def signup():
@@ -79,6 +100,7 @@ def login():
 
 # Route to store GAD-7 and PHQ-9 scores
 @auth.route('/assessments', methods=['POST'])
+@idempotent
 def store_assessment():
     """
     Stores GAD-7 and PHQ-9 scores for a user, ensuring only one entry per day.
@@ -93,9 +115,22 @@ def store_assessment():
         if not user_id or (gad7_score is None and phq9_score is None):
             return jsonify({'error': 'User ID and at least one score (GAD-7 or PHQ-9) are required'}), 400
 
+        # Validate the user ID before it is used to pick a shard
+        user_id = parse_user_id(user_id)
+        if user_id is None:
+            return jsonify({'error': 'User ID must be a positive integer'}), 400
+
+        # Check if the user exists
+        user = User.query.get(user_id)
+        if not user:
+            return jsonify({'error': 'User not found'}), 404
+
+        # Resolve the shard holding this user's rows
+        session = get_user_session(user_id, write=True)
+
         # Check if an assessment already exists for the user today
         today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        existing_assessment = Assessment.query.filter(
+        existing_assessment = session.query(Assessment).filter(
             Assessment.user_id == user_id,
             Assessment.created_at >= today_start
         ).first()
@@ -110,13 +145,13 @@ def store_assessment():
             phq9_score=phq9_score,
             created_at=datetime.utcnow()
         )
-        db.session.add(new_assessment)
-        db.session.commit()
+        session.add(new_assessment)
+        session.commit()
 
         return jsonify({'message': 'Assessment stored successfully'}), 201
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_sessions()
         return jsonify({'error': 'Database error', 'details': str(e)}), 500
 
     except Exception as e:
@@ -129,8 +164,11 @@ def fetch_assessments(user_id):
     Fetches all GAD-7 and PHQ-9 scores for a user.
     """
     try:
+        # Resolve the shard holding this user's rows
+        session = get_user_session(user_id)
+
         # Fetch assessments for the given user ID
-        assessments = Assessment.query.filter_by(user_id=user_id).order_by(Assessment.created_at.desc()).all()
+        assessments = session.query(Assessment).filter_by(user_id=user_id).order_by(Assessment.created_at.desc()).all()
 
         if not assessments:
             return jsonify({'error': 'No assessments found for the user'}), 404
@@ -153,6 +191,7 @@ def fetch_assessments(user_id):
         return jsonify({'error': 'An unexpected error occurred', 'details': str(e)}), 500
 
 @auth.route('/chat', methods=['POST'])
+@idempotent
 def chat():
     """
     Handles user messages, generates bot replies, and stores both in the database.
@@ -166,21 +205,34 @@ def chat():
         if not user_id or not user_message:
             return jsonify({'error': 'User ID and message are required'}), 400
 
+        # Validate the user ID before it is used to pick a shard
+        user_id = parse_user_id(user_id)
+        if user_id is None:
+            return jsonify({'error': 'User ID must be a positive integer'}), 400
+
+        # Check if the user exists
+        user = User.query.get(user_id)
+        if not user:
+            return jsonify({'error': 'User not found'}), 404
+
+        # Resolve the shard holding this user's rows
+        session = get_user_session(user_id, write=True)
+
         # Generate a bot reply (this is a placeholder; replace with your bot logic)
         bot_reply = f"Hello! You said: {user_message}"
 
         # Store the user message and bot reply in the database
         user_chat = ChatHistory(user_id=user_id, message=user_message, sender='user', created_at=datetime.utcnow())
         bot_chat = ChatHistory(user_id=user_id, message=bot_reply, sender='bot', created_at=datetime.utcnow())
-        db.session.add(user_chat)
-        db.session.add(bot_chat)
-        db.session.commit()
+        session.add(user_chat)
+        session.add(bot_chat)
+        session.commit()
 
         # Send the bot reply back to the frontend
         return jsonify({'bot_reply': bot_reply}), 200
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_sessions()
         return jsonify({'error': 'Database error', 'details': str(e)}), 500
 
     except Exception as e:
@@ -192,8 +244,11 @@ def get_chat_history(user_id):
     Fetches the chat history for a user.
     """
     try:
+        # Resolve the shard holding this user's rows
+        session = get_user_session(user_id)
+
         # Fetch chat history for the user
-        chat_history = ChatHistory.query.filter_by(user_id=user_id).order_by(ChatHistory.created_at.asc()).all()
+        chat_history = session.query(ChatHistory).filter_by(user_id=user_id).order_by(ChatHistory.created_at.asc()).all()
 
         # Serialize the chat history
         history = [
@@ -213,6 +268,7 @@ def get_chat_history(user_id):
         return jsonify({'error': 'An unexpected error occurred', 'details': str(e)}), 500
 
 @auth.route('/journal', methods=['POST'])
+@idempotent
 def add_journal():
     """
     Adds a daily journal entry for a user, ensuring only one entry per day.
@@ -226,9 +282,22 @@ def add_journal():
         if not user_id or not entry:
             return jsonify({'error': 'User ID and journal entry are required'}), 400
 
+        # Validate the user ID before it is used to pick a shard
+        user_id = parse_user_id(user_id)
+        if user_id is None:
+            return jsonify({'error': 'User ID must be a positive integer'}), 400
+
+        # Check if the user exists
+        user = User.query.get(user_id)
+        if not user:
+            return jsonify({'error': 'User not found'}), 404
+
+        # Resolve the shard holding this user's rows
+        session = get_user_session(user_id, write=True)
+
         # Check if a journal entry already exists for the user today
         today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        existing_journal = JournalEntry.query.filter(
+        existing_journal = session.query(JournalEntry).filter(
             JournalEntry.user_id == user_id,
             JournalEntry.created_at >= today_start
         ).first()
@@ -238,13 +307,13 @@ def add_journal():
 
         # Create a new journal entry
         new_journal = JournalEntry(user_id=user_id, entry=entry, created_at=datetime.utcnow())
-        db.session.add(new_journal)
-        db.session.commit()
+        session.add(new_journal)
+        session.commit()
 
         return jsonify({'message': 'Journal entry added successfully'}), 201
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_sessions()
         return jsonify({'error': 'Database error', 'details': str(e)}), 500
 
     except Exception as e:
@@ -256,8 +325,11 @@ def fetch_journals(user_id):
     Fetches all journal entries for a user.
     """
     try:
+        # Resolve the shard holding this user's rows
+        session = get_user_session(user_id)
+
         # Fetch all journal entries for the user
-        journals = JournalEntry.query.filter_by(user_id=user_id).order_by(JournalEntry.created_at.desc()).all()
+        journals = session.query(JournalEntry).filter_by(user_id=user_id).order_by(JournalEntry.created_at.desc()).all()
 
         if not journals:
             return jsonify({'error': 'No journal entries found for the user'}), 404
@@ -279,6 +351,7 @@ def fetch_journals(user_id):
         return jsonify({'error': 'An unexpected error occurred', 'details': str(e)}), 500
 
 @auth.route('/moodlog', methods=['POST'])
+@idempotent
 def add_mood_log():
     """
     Adds a daily mood log entry for a user, with an optional note.
@@ -294,14 +367,22 @@ def add_mood_log():
         if not user_id or not mood:
             return jsonify({'error': 'User ID and mood are required'}), 400
 
+        # Validate the user ID before it is used to pick a shard
+        user_id = parse_user_id(user_id)
+        if user_id is None:
+            return jsonify({'error': 'User ID must be a positive integer'}), 400
+
         # Check if the user exists
         user = User.query.get(user_id)
         if not user:
             return jsonify({'error': 'User not found'}), 404
 
+        # Resolve the shard holding this user's rows
+        session = get_user_session(user_id, write=True)
+
         # Check if a mood log already exists for the user today
         today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        existing_mood_log = MoodLog.query.filter(
+        existing_mood_log = session.query(MoodLog).filter(
             MoodLog.user_id == user_id,
             MoodLog.created_at >= today_start
         ).first()
@@ -311,13 +392,13 @@ def add_mood_log():
 
         # Create a new mood log entry
         new_mood_log = MoodLog(user_id=user_id, mood=mood, note=note, created_at=datetime.utcnow())
-        db.session.add(new_mood_log)
-        db.session.commit()
+        session.add(new_mood_log)
+        session.commit()
 
         return jsonify({'message': 'Mood log added successfully'}), 201
 
     except SQLAlchemyError as e:
-        db.session.rollback()
+        rollback_sessions()
         return jsonify({'error': 'Database error', 'details': str(e)}), 500
 
     except Exception as e:
@@ -329,8 +410,11 @@ def fetch_mood_logs(user_id):
     Fetches all mood log entries for a user.
     """
     try:
+        # Resolve the shard holding this user's rows
+        session = get_user_session(user_id)
+
         # Fetch all mood logs for the user
-        mood_logs = MoodLog.query.filter_by(user_id=user_id).order_by(MoodLog.created_at.desc()).all()
+        mood_logs = session.query(MoodLog).filter_by(user_id=user_id).order_by(MoodLog.created_at.desc()).all()
 
         if not mood_logs:
             return jsonify({'error': 'No mood logs found for the user'}), 404
@@ -352,6 +436,32 @@ def fetch_mood_logs(user_id):
     except Exception as e:
         return jsonify({'error': 'An unexpected error occurred', 'details': str(e)}), 500
 
+@auth.route('/admin/analytics', methods=['GET'])
+def admin_analytics():
+    """
+    Returns population-level assessment and mood statistics from the analytics snapshot.
+    Requires the X-Admin-Token header to match the ADMIN_TOKEN config value.
+    """
+    try:
+        admin_token = current_app.config.get('ADMIN_TOKEN')
+        if not admin_token:
+            return jsonify({'error': 'Admin access is not configured'}), 403
+
+        if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), admin_token):
+            return jsonify({'error': 'Invalid admin token'}), 401
+
+        # Imported lazily so NumPy stays off the request path of regular workers
+        from analytics import get_report
+
+        report = get_report(current_app.config['ANALYTICS_SNAPSHOT_DIR'], current_app.config['ANALYTICS_MIN_CELL_SIZE'])
+        return jsonify({'report': report}), 200
+
+    except FileNotFoundError as e:
+        return jsonify({'error': 'No analytics snapshot available', 'details': str(e)}), 404
+
+    except Exception as e:
+        return jsonify({'error': 'An unexpected error occurred', 'details': str(e)}), 500
+
 def prepare_context(chat_history, max_tokens):
     """
     Prepares the context for LLM input by summarizing older messages if the token count exceeds the limit.
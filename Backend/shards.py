@@ -0,0 +1,409 @@
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.schema import CreateTable, CreateIndex
+import click
+
+from app import db
+
+shards_cli = AppGroup('shards', help='Manage per-user database shards.')
+
+
+def get_sharded_models():
+    """Returns the models that are accessed only by user_id and live on the shards."""
+    from models import Assessment, MoodLog, ChatHistory, JournalEntry
+    return [Assessment, MoodLog, ChatHistory, JournalEntry]
+
+
+class ShardRouter:
+    """
+    Maps a user_id to one of the database binds listed in SHARD_URIS.
+
+    With the 'hash' strategy a user lives on shard `user_id % shard_count`. Changing
+    SHARD_URIS re-maps most users to a different shard, so a hash deployment cannot be
+    resized in place.
+
+    The 'directory' strategy records each user's shard in the `user_shard` table the
+    first time rows are written for the user (placed by the same hash), and afterwards
+    always follows that table; reads of unrecorded users use the hash without writing.
+    This is what allows users to be moved between shards and shards to be added: run
+    `flask shards pin-users` before changing SHARD_URIS so users that were never
+    routed are recorded under the old shard count.
+
+    Per-user rows left in the default database are invisible to the routes, so
+    routing is refused until `flask shards import-default` has moved them.
+    """
+
+    def __init__(self, shard_count, strategy):
+        self.shard_count = shard_count
+        self.strategy = strategy
+        self._sessions = {}
+        self._default_imported = False
+
+    @property
+    def enabled(self):
+        """True when the per-user tables are spread over shard binds."""
+        return self.shard_count > 0
+
+    def hash_shard(self, user_id):
+        """Returns the default shard for a user_id."""
+        return int(user_id) % self.shard_count
+
+    def require_directory(self, action):
+        """Raises ValueError unless sharding is enabled with the directory strategy."""
+        if not self.enabled or self.strategy != 'directory':
+            raise ValueError(f'{action} requires SHARD_URIS and SHARD_STRATEGY=directory')
+
+    def shard_for_user(self, user_id):
+        """Returns the shard a user's rows live on, without recording anything."""
+        if self.strategy != 'directory':
+            return self.hash_shard(user_id)
+
+        from models import UserShard
+        assignment = db.session.get(UserShard, int(user_id))
+        return assignment.shard if assignment else self.hash_shard(user_id)
+
+    def assign_shard(self, user_id):
+        """
+        Returns the shard new rows for a user are written to, recording it under the directory strategy.
+
+        Raises:
+            ValueError: If the user does not exist, since directory rows are only kept for real users.
+        """
+        if self.strategy != 'directory':
+            return self.hash_shard(user_id)
+
+        from models import User, UserShard
+        assignment = db.session.get(UserShard, int(user_id))
+        if assignment:
+            return assignment.shard
+        if db.session.get(User, int(user_id)) is None:
+            raise ValueError(f'User {user_id} does not exist')
+
+        shard = self.hash_shard(user_id)
+        db.session.add(UserShard(user_id=int(user_id), shard=shard))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another request recorded the user first
+            db.session.rollback()
+            assignment = db.session.get(UserShard, int(user_id))
+            if assignment:
+                return assignment.shard
+        return shard
+
+    def pin_users(self):
+        """
+        Records the current shard of every user without a directory row.
+
+        Returns:
+            int: Number of users recorded.
+        """
+        from models import User, UserShard
+
+        self.require_directory('Pinning users')
+
+        user_ids = [user_id for (user_id,) in db.session.query(User.id).filter(
+            ~User.id.in_(db.session.query(UserShard.user_id))
+        )]
+        for start in range(0, len(user_ids), 1000):
+            db.session.add_all(UserShard(user_id=user_id, shard=self.hash_shard(user_id))
+                               for user_id in user_ids[start:start + 1000])
+            db.session.commit()
+        return len(user_ids)
+
+    def session_for_shard(self, shard):
+        """Returns the scoped session bound to a shard, creating it on first use."""
+        if shard not in self._sessions:
+            engine = db.engines[f'shard_{shard}']
+            self._sessions[shard] = scoped_session(sessionmaker(bind=engine))
+        return self._sessions[shard]
+
+    def session_for_user(self, user_id, write=False):
+        """
+        Returns the session holding a user's rows.
+
+        Args:
+            user_id (int): The user whose rows are accessed.
+            write (bool): True when rows will be added, which records the user's shard.
+
+        Raises:
+            RuntimeError: If per-user rows are still waiting in the default database.
+        """
+        if not self.enabled:
+            return db.session
+        self._check_default_imported()
+        shard = self.assign_shard(user_id) if write else self.shard_for_user(user_id)
+        return self.session_for_shard(shard)
+
+    def default_has_rows(self):
+        """Returns True while any per-user table in the default database still has rows."""
+        return any(db.session.query(model.id).limit(1).first() is not None for model in get_sharded_models())
+
+    def _check_default_imported(self):
+        """Refuses to route until the default database no longer holds per-user rows."""
+        if self._default_imported:
+            return
+        if self.default_has_rows():
+            current_app.logger.error('Per-user rows are still in the default database; run `flask shards import-default`')
+            raise RuntimeError('Sharded data is unavailable until `flask shards import-default` has run')
+        # Rows never return to the default database, so one clean check per process is enough
+        self._default_imported = True
+
+    def all_sessions(self):
+        """Returns one session per database holding per-user rows, keyed by bind name."""
+        if not self.enabled:
+            return {'default': db.session}
+        return {f'shard_{shard}': self.session_for_shard(shard) for shard in range(self.shard_count)}
+
+    def rollback(self):
+        """Rolls back the default session and every open shard session."""
+        db.session.rollback()
+        for session in self._sessions.values():
+            session.rollback()
+
+    def remove_sessions(self):
+        """Closes the shard sessions at the end of an app context."""
+        for session in self._sessions.values():
+            session.remove()
+
+    def create_tables(self):
+        """
+        Creates the per-user tables on every shard.
+
+        The `user` table only exists on the default database, so the foreign keys that
+        point at it are left out of the shard tables. Existing tables are left as they
+        are: Alembic migrations only run against the default database, so a column
+        change to a per-user model has to be applied to every shard by hand.
+        """
+        tables = [model.__table__ for model in get_sharded_models()]
+        for shard in range(self.shard_count):
+            with db.engines[f'shard_{shard}'].begin() as connection:
+                for table in tables:
+                    if inspect(connection).has_table(table.name):
+                        continue
+                    connection.execute(CreateTable(table, include_foreign_key_constraints=[]))
+                    for index in table.indexes:
+                        connection.execute(CreateIndex(index))
+
+    def schema_problems(self):
+        """
+        Compares every shard's per-user tables with the models.
+
+        Returns:
+            list: Descriptions of missing tables and columns; empty when all shards match.
+        """
+        problems = []
+        for shard in range(self.shard_count):
+            inspector = inspect(db.engines[f'shard_{shard}'])
+            for model in get_sharded_models():
+                table = model.__table__
+                if not inspector.has_table(table.name):
+                    problems.append(f'shard_{shard} has no {table.name} table')
+                    continue
+                existing = {column['name'] for column in inspector.get_columns(table.name)}
+                missing = [column.name for column in table.columns if column.name not in existing]
+                if missing:
+                    problems.append(f'shard_{shard}.{table.name} is missing {", ".join(missing)}')
+        return problems
+
+    def check_tables(self):
+        """
+        Verifies that every shard has the per-user tables and columns of the models.
+
+        Raises:
+            RuntimeError: If a shard is missing a table or column.
+        """
+        problems = self.schema_problems()
+        # Drop pooled connections so forked workers never share the parent's sockets
+        for shard in range(self.shard_count):
+            db.engines[f'shard_{shard}'].dispose()
+        if problems:
+            raise RuntimeError(
+                f"Shard schema does not match the models ({'; '.join(problems)}); run `flask shards "
+                f"create-tables` for missing tables and add missing columns to each shard by hand"
+            )
+
+    def import_default(self):
+        """
+        Moves the per-user rows of the default database to each user's shard.
+
+        Runs one user at a time: the user's rows are copied to their shard and then
+        deleted from the default database. A user whose copy was interrupted still has
+        rows in the default database, so their partial copy is cleared and the user is
+        copied again on the next run. Routing is refused until the import finishes, so
+        the shards receive no other rows for these users in the meantime.
+
+        Returns:
+            tuple: (users, rows) moved.
+
+        Raises:
+            ValueError: If sharding is not enabled.
+        """
+        if not self.enabled:
+            raise ValueError('Importing requires SHARD_URIS')
+
+        models = get_sharded_models()
+        user_ids = sorted(set().union(*(
+            {user_id for (user_id,) in db.session.query(model.user_id).distinct()} for model in models
+        )))
+        moved = 0
+        try:
+            for user_id in user_ids:
+                # Rows of deleted users are kept on their hash shard rather than dropped
+                try:
+                    shard = self.assign_shard(user_id)
+                except ValueError:
+                    shard = self.hash_shard(user_id)
+                target = self.session_for_shard(shard)
+                for model in models:
+                    target.query(model).filter_by(user_id=user_id).delete(synchronize_session=False)
+                    columns = [column.key for column in model.__table__.columns if not column.primary_key]
+                    for row in db.session.query(model).filter_by(user_id=user_id).all():
+                        target.add(model(**{column: getattr(row, column) for column in columns}))
+                        moved += 1
+                target.commit()
+
+                for model in models:
+                    db.session.query(model).filter_by(user_id=user_id).delete(synchronize_session=False)
+                db.session.commit()
+        except Exception:
+            self.rollback()
+            raise
+
+        return len(user_ids), moved
+
+    def move_user(self, user_id, target_shard):
+        """
+        Moves all of a user's rows to another shard and records it in the directory.
+
+        Rows are copied first, then the directory is updated, and finally the user's
+        rows are deleted from every shard other than the target. Each step can be
+        repeated, so a move that failed at any point is finished by running it again.
+        Row ids are reassigned by the target shard. The user should not be writing
+        while the move runs.
+
+        Args:
+            user_id (int): The user whose rows should be moved.
+            target_shard (int): Index of the destination shard.
+
+        Returns:
+            int: Number of rows copied to the target shard.
+
+        Raises:
+            ValueError: If sharding or the directory strategy is not enabled, or the target shard is unknown.
+        """
+        from models import UserShard
+
+        self.require_directory('Moving users')
+        if not 0 <= target_shard < self.shard_count:
+            raise ValueError(f'Target shard must be between 0 and {self.shard_count - 1}')
+
+        source_shard = self.shard_for_user(user_id)
+        target = self.session_for_shard(target_shard)
+        moved = 0
+        try:
+            if source_shard != target_shard:
+                source = self.session_for_shard(source_shard)
+                for model in get_sharded_models():
+                    # Clear leftovers from an earlier interrupted move before copying
+                    target.query(model).filter_by(user_id=user_id).delete(synchronize_session=False)
+                    columns = [column.key for column in model.__table__.columns if not column.primary_key]
+                    for row in source.query(model).filter_by(user_id=user_id).all():
+                        target.add(model(**{column: getattr(row, column) for column in columns}))
+                        moved += 1
+                target.commit()
+
+                db.session.merge(UserShard(user_id=user_id, shard=target_shard))
+                db.session.commit()
+
+            # The directory now points at the target, so rows anywhere else are stale copies
+            for shard in range(self.shard_count):
+                if shard == target_shard:
+                    continue
+                session = self.session_for_shard(shard)
+                for model in get_sharded_models():
+                    session.query(model).filter_by(user_id=user_id).delete(synchronize_session=False)
+                session.commit()
+        except Exception:
+            self.rollback()
+            raise
+
+        return moved
+
+
+def get_shard_router():
+    """Returns the shard router for the current app, creating it on first use."""
+    router = current_app.extensions.get('shards')
+    if router is None:
+        router = ShardRouter(len(current_app.config['SHARD_URIS']), current_app.config['SHARD_STRATEGY'])
+        current_app.extensions['shards'] = router
+    return router
+
+
+def get_user_session(user_id, write=False):
+    """Returns the database session holding the given user's rows; pass write=True before adding rows."""
+    return get_shard_router().session_for_user(user_id, write)
+
+
+def rollback_sessions():
+    """Rolls back the default session and any shard sessions used by the request."""
+    get_shard_router().rollback()
+
+
+def remove_shard_sessions(exception=None):
+    """Teardown handler that closes shard sessions opened during the app context."""
+    router = current_app.extensions.get('shards')
+    if router is not None:
+        router.remove_sessions()
+
+
+@shards_cli.command('move-user')
+@click.argument('user_id', type=int)
+@click.argument('target_shard', type=int)
+def move_user_command(user_id, target_shard):
+    """Moves USER_ID's rows to TARGET_SHARD."""
+    router = get_shard_router()
+    try:
+        router.require_directory('Moving users')
+        source_shard = router.shard_for_user(user_id)
+        moved = router.move_user(user_id, target_shard)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Moved {moved} rows for user {user_id} from shard {source_shard} to shard {target_shard}')
+    if moved:
+        click.echo('Moved rows get new ids; run `flask analytics snapshot --rebuild` before the next report')
+
+
+@shards_cli.command('pin-users')
+def pin_users_command():
+    """Records every user's current shard; run before changing SHARD_URIS."""
+    try:
+        pinned = get_shard_router().pin_users()
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Pinned {pinned} users to their current shard')
+
+
+@shards_cli.command('import-default')
+def import_default_command():
+    """Moves per-user rows from the default database to the shards."""
+    try:
+        users, rows = get_shard_router().import_default()
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Moved {rows} rows for {users} users from the default database to the shards')
+    if rows:
+        click.echo('Run `flask analytics snapshot --rebuild` so the snapshot reads the shards from scratch')
+
+
+@shards_cli.command('create-tables')
+def create_tables_command():
+    """Creates the per-user tables on every shard."""
+    router = get_shard_router()
+    if not router.enabled:
+        raise click.ClickException('Sharding is disabled; set SHARD_URIS to enable it')
+    router.create_tables()
+    click.echo(f'Created per-user tables on {router.shard_count} shards')
@@ -0,0 +1,76 @@
+from flask_socketio import SocketIO, emit
+from datetime import datetime
+
+from models import User, ChatHistory
+from routes import prepare_context, parse_user_id
+from shards import get_user_session, rollback_sessions
+
+socketio = SocketIO()  # Attached to the app by init_extensions when ENABLE_SOCKETIO is set
+
+# WebSocket event handlers
+@socketio.on('connect')
+def handle_connect():
+    """Handles WebSocket connection events."""
+    print("Client connected.")
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    """Handles WebSocket disconnection events."""
+    print("Client disconnected.")
+
+@socketio.on('message')
+def handle_message(data):
+    """
+    Handles incoming WebSocket messages from the client.
+
+    Args:
+        data (dict): Incoming message data. Expected keys: "user_id", "message".
+    """
+    try:
+        user_id = data.get('user_id')
+        user_message = data.get('message')
+
+        # Validate input
+        if not user_id or not user_message:
+            emit('error', {'error': 'User ID and message are required'})
+            return
+
+        # Validate the user ID before it is used to pick a shard
+        user_id = parse_user_id(user_id)
+        if user_id is None:
+            emit('error', {'error': 'User ID must be a positive integer'})
+            return
+
+        # Check if the user exists
+        if not User.query.get(user_id):
+            emit('error', {'error': 'User not found'})
+            return
+
+        # Resolve the shard holding this user's chat history
+        session = get_user_session(user_id, write=True)
+
+        # Save user message to the database
+        user_chat = ChatHistory(user_id=user_id, message=user_message, sender='user', created_at=datetime.utcnow())
+        session.add(user_chat)
+        session.commit()
+
+        # Prepare LLM context
+        chat_history = session.query(ChatHistory).filter_by(user_id=user_id).order_by(ChatHistory.created_at.asc()).all()
+        chat_history_list = [{'sender': chat.sender, 'message': chat.message, 'timestamp': chat.created_at} for chat in chat_history]
+        context = prepare_context(chat_history_list, max_tokens=3000)
+
+        # Generate bot reply (placeholder logic)
+        bot_reply = f"Bot reply to: {user_message}"
+
+        # Save bot reply to the database
+        bot_chat = ChatHistory(user_id=user_id, message=bot_reply, sender='bot', created_at=datetime.utcnow())
+        session.add(bot_chat)
+        session.commit()
+
+        # Emit bot reply back to the frontend
+        emit('bot_reply', {'bot_reply': bot_reply})
+
+    except Exception as e:
+        rollback_sessions()
+        # Handle unexpected errors
+        emit('error', {'error': 'An unexpected error occurred', 'details': str(e)})
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+# The backend modules are imported top-level (`import app`), as when running from Backend/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def app_env(tmp_path, monkeypatch):
+    """Environment for an app on a throwaway SQLite database, without SocketIO or CORS."""
+    monkeypatch.setenv('DATABASE_URI', f'sqlite:///{tmp_path / "main.db"}')
+    monkeypatch.setenv('ENABLE_SOCKETIO', '0')
+    monkeypatch.setenv('CORS_ORIGINS', '')
+    return monkeypatch
+
+
+@pytest.fixture
+def app(app_env):
+    """App keeping every table in the default database."""
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def sharded_app(app_env, tmp_path):
+    """App with two SQLite shards routed by the directory strategy."""
+    app_env.setenv('SHARD_URIS', ','.join(f'sqlite:///{tmp_path / f"shard_{i}.db"}' for i in range(2)))
+    app_env.setenv('SHARD_STRATEGY', 'directory')
+
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        yield app
@@ -0,0 +1,114 @@
+from datetime import datetime
+
+import numpy as np
+
+import analytics
+from analytics import (MISSING, GAD7_BANDS, band_transitions, export_snapshot, join_users, latest_per_user,
+                       load_snapshot, percentiles, value_counts)
+from app import db
+from models import User, Assessment
+
+
+def test_latest_per_user_picks_most_recent_row():
+    user_ids = np.array([2, 1, 2, 1])
+    created_at = np.array([1, 5, 3, 2])
+
+    assert latest_per_user(user_ids, created_at).tolist() == [1, 2]
+
+
+def test_join_users_maps_unknown_users_and_missing_values():
+    users = {'id': np.array([1, 2, 4]), 'age': np.array([20, MISSING, 70]), 'gender': np.array(['f', '', 'm'])}
+
+    age_bands, genders = join_users(np.array([4, 1, 3, 2]), users)
+
+    assert age_bands.tolist() == ['65+', '18-24', 'unknown', 'unknown']
+    assert genders.tolist() == ['m', 'f', 'unknown', 'unknown']
+
+
+def test_band_transitions_counts_consecutive_pairs():
+    # User 1 goes minimal -> moderate -> moderate, user 2 goes mild -> minimal
+    user_ids = np.array([1, 1, 1, 2, 2, 2])
+    created_at = np.array([1, 2, 3, 1, 2, 3])
+    scores = np.array([3, 12, 12, 6, MISSING, 3])
+
+    result = band_transitions(user_ids, created_at, scores, GAD7_BANDS, min_cell_size=1)
+
+    assert result['counts'] == [[0, 0, 1, 0], [1, 0, 0, 0], [0, 0, 1, 0], [0, 0, 0, 0]]
+    suppressed = band_transitions(user_ids, created_at, scores, GAD7_BANDS, min_cell_size=2)
+    assert suppressed['counts'] == [[0, 0, None, 0], [None, 0, 0, 0], [0, 0, None, 0], [0, 0, 0, 0]]
+
+
+def test_value_counts_hides_cells_that_totals_would_reveal():
+    cells = {('65+', 'mild'): 3, ('65+', 'moderate'): 7, ('65+', 'severe'): 5,
+             ('25-34', 'mild'): 6, ('25-34', 'moderate'): 8, ('25-34', 'severe'): 9}
+    groups = np.array([group for (group, _), count in cells.items() for _ in range(count)], dtype=object)
+    values = np.array([value for (_, value), count in cells.items() for _ in range(count)], dtype=object)
+    user_ids = np.arange(len(values))
+
+    result = value_counts(values, user_ids, groups, min_cell_size=5)
+
+    # 65+ mild is too small; 65+ severe hides it from the group total, and the 25-34
+    # cells hide it from the overall frequencies
+    assert result['65+'] == {'mild': None, 'moderate': 7, 'severe': None}
+    assert result['25-34'] == {'mild': None, 'moderate': 8, 'severe': None}
+    assert result['all'] == {'mild': 9, 'moderate': 15, 'severe': 14}
+
+
+def test_value_counts_counts_distinct_users():
+    values = np.array(['happy'] * 6, dtype=object)
+
+    assert value_counts(values, np.array([1, 1, 1, 2, 2, 2]))['all'] == {'happy': None}
+    assert value_counts(values, np.arange(6))['all'] == {'happy': 6}
+
+
+def test_percentiles_suppresses_small_group_and_its_complement():
+    groups = np.array(['a'] * 6 + ['b'] * 3 + ['c'] * 7, dtype=object)
+    scores = np.arange(16)
+
+    result = percentiles(scores, groups, min_cell_size=5)
+
+    assert result['a'] == {'suppressed': True}
+    assert result['b'] == {'suppressed': True}
+    assert result['c']['count'] == 7
+    assert result['c']['p50'] == 12.0
+    assert result['all']['count'] == 16
+
+
+def add_assessments(user_id, scores):
+    for day, score in scores:
+        db.session.add(Assessment(user_id=user_id, gad7_score=score, created_at=datetime(2024, 1, day)))
+    db.session.commit()
+
+
+def test_export_appends_incrementally_and_compacts(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(analytics, 'BATCH_SIZE', 2)
+    monkeypatch.setattr(analytics, 'MAX_CHUNKS', 2)
+    snapshot_dir = str(tmp_path / 'snapshot')
+    user = User(email='user@example.com', password='hashed', age=30)
+    db.session.add(user)
+    db.session.commit()
+    add_assessments(user.id, [(day, day) for day in range(1, 6)])
+
+    assert export_snapshot(snapshot_dir)['assessment'] == 5
+    # Three chunks of at most two rows were merged once there were more than MAX_CHUNKS
+    assert len(analytics._read_manifest(snapshot_dir)['assessment']['chunks']) == 1
+
+    add_assessments(user.id, [(6, 6), (7, 'abc'), (8, 100000)])
+    assert export_snapshot(snapshot_dir)['assessment'] == 3
+    assert export_snapshot(snapshot_dir)['assessment'] == 0
+
+    tables = load_snapshot(snapshot_dir)
+    assert tables['assessment']['gad7_score'].tolist() == [1, 2, 3, 4, 5, 6, MISSING, MISSING]
+    assert tables['user']['age'].tolist() == [30]
+
+
+def test_rebuild_only_removes_snapshot_files(app, tmp_path):
+    snapshot_dir = tmp_path / 'snapshot'
+    snapshot_dir.mkdir()
+    (snapshot_dir / 'keep.txt').write_text('not part of the snapshot')
+
+    export_snapshot(str(snapshot_dir))
+    export_snapshot(str(snapshot_dir), rebuild=True)
+
+    assert (snapshot_dir / 'keep.txt').exists()
+    assert (snapshot_dir / 'manifest.json').exists()
@@ -0,0 +1,132 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from idempotency import idempotent, get_idempotency_store, MemoryIdempotencyStore
+from models import User, IdempotencyKey
+
+
+@pytest.fixture(params=['memory', 'database'])
+def client(request, app_env):
+    app_env.setenv('IDEMPOTENCY_BACKEND', request.param)
+    app_env.setenv('IDEMPOTENCY_LOCK_TIMEOUT', '60')
+
+    from app import create_app
+    app = create_app()
+
+    calls = []
+
+    @idempotent
+    def failing():
+        calls.append(1)
+        return {'error': 'failed'}, 503
+
+    app.add_url_rule('/failing', 'failing', failing, methods=['POST'])
+    app.failing_calls = calls
+
+    with app.app_context():
+        user = User(email='user@example.com', password='hashed')
+        db.session.add(user)
+        db.session.commit()
+        app.user_id = user.id
+        yield app.test_client()
+
+
+def post_journal(client, key, entry='entry'):
+    return client.post('/api/journal', json={'user_id': client.application.user_id, 'entry': entry},
+                       headers={'Idempotency-Key': key})
+
+
+def test_repeated_key_replays_response(client):
+    first = post_journal(client, 'key-1')
+    second = post_journal(client, 'key-1')
+
+    assert first.status_code == 201
+    assert second.status_code == 201
+    assert second.get_json() == first.get_json()
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    # Without a key the once-per-day check runs, proving the replay did not
+    assert post_journal(client, '').status_code == 400
+
+
+def test_key_reused_with_different_body_is_rejected(client):
+    post_journal(client, 'key-1', entry='first')
+
+    response = post_journal(client, 'key-1', entry='second')
+
+    assert response.status_code == 422
+
+
+def test_key_in_progress_returns_conflict(client):
+    from idempotency import hash_request
+    with client.application.test_request_context(
+            '/api/journal', method='POST', json={'user_id': client.application.user_id, 'entry': 'entry'}):
+        get_idempotency_store().reserve('/api/journal:key-1', hash_request())
+
+    response = post_journal(client, 'key-1')
+
+    assert response.status_code == 409
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_server_error_releases_key(client):
+    assert client.post('/failing', json={}, headers={'Idempotency-Key': 'key-1'}).status_code == 503
+    assert client.post('/failing', json={}, headers={'Idempotency-Key': 'key-1'}).status_code == 503
+
+    assert len(client.application.failing_calls) == 2
+
+
+def test_database_store_takes_over_abandoned_key(app_env):
+    app_env.setenv('IDEMPOTENCY_BACKEND', 'database')
+
+    from app import create_app
+    with create_app().app_context():
+        store = get_idempotency_store()
+
+        def reserve():
+            # Each reservation comes from a separate request with its own session
+            db.session.remove()
+            return store.reserve('key-1', 'hash')
+
+        assert reserve() is None
+        assert reserve() == ('hash', None, None)
+
+        # Age the reservation past the lock timeout, as if its worker had died
+        record = db.session.get(IdempotencyKey, 'key-1')
+        record.created_at = datetime.utcnow() - timedelta(seconds=store.lock_timeout + 1)
+        db.session.commit()
+
+        assert reserve() is None
+        store.complete('key-1', 201, '{}')
+        assert reserve() == ('hash', 201, '{}')
+
+
+def test_database_store_prunes_expired_keys(app_env):
+    app_env.setenv('IDEMPOTENCY_BACKEND', 'database')
+
+    from app import create_app
+    with create_app().app_context():
+        store = get_idempotency_store()
+        db.session.add(IdempotencyKey(key='old', request_hash='hash', status_code=201, body='{}',
+                                      created_at=datetime.utcnow() - timedelta(seconds=store.ttl + 1)))
+        db.session.commit()
+
+        # Pruning is throttled, so reserving a key does not delete anything yet
+        store.reserve('new', 'hash')
+        assert db.session.get(IdempotencyKey, 'old') is not None
+
+        assert store.prune() == 1
+        assert db.session.get(IdempotencyKey, 'new') is not None
+
+
+def test_memory_store_never_evicts_in_progress_keys():
+    store = MemoryIdempotencyStore(ttl=3600, max_keys=2, lock_timeout=60)
+    store.reserve('in-progress', 'hash')
+    store.reserve('completed', 'hash')
+    store.complete('completed', 201, '{}')
+
+    store.reserve('new', 'hash')
+
+    assert store.reserve('in-progress', 'hash') == ('hash', None, None)
+    assert store.reserve('completed', 'hash') is None
@@ -0,0 +1,141 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import inspect, text
+
+from app import db
+from models import User, UserShard, Assessment, JournalEntry
+from shards import get_shard_router
+
+
+def create_user(email='user@example.com'):
+    user = User(email=email, password='hashed')
+    db.session.add(user)
+    db.session.commit()
+    return user.id
+
+
+def add_rows(session, user_id):
+    session.add(Assessment(user_id=user_id, gad7_score=6, phq9_score=11, created_at=datetime(2024, 1, 1)))
+    session.add(JournalEntry(user_id=user_id, entry='entry', created_at=datetime(2024, 1, 1)))
+    session.commit()
+
+
+def count_rows(session, user_id):
+    return sum(session.query(model).filter_by(user_id=user_id).count() for model in (Assessment, JournalEntry))
+
+
+def test_shard_tables_have_no_foreign_keys(sharded_app):
+    for shard in range(2):
+        inspector = inspect(db.engines[f'shard_{shard}'])
+        assert inspector.has_table('assessment')
+        assert not inspector.has_table('user')
+        assert inspector.get_foreign_keys('assessment') == []
+
+
+def test_directory_records_shard_on_first_write(sharded_app):
+    router = get_shard_router()
+    user_id = create_user()
+
+    assert router.shard_for_user(user_id) == router.hash_shard(user_id)
+    assert db.session.get(UserShard, user_id) is None
+
+    assert router.assign_shard(user_id) == router.hash_shard(user_id)
+    assert db.session.get(UserShard, user_id).shard == router.hash_shard(user_id)
+
+    # Growing the shard count must not re-map an already recorded user
+    router.shard_count = 3
+    assert router.shard_for_user(user_id) == user_id % 2
+
+
+def test_pin_users_records_unrouted_users(sharded_app):
+    user_ids = [create_user(f'user{i}@example.com') for i in range(3)]
+
+    assert get_shard_router().pin_users() == 3
+    assert {row.user_id for row in UserShard.query.all()} == set(user_ids)
+    assert get_shard_router().pin_users() == 0
+
+
+def test_reads_do_not_record_unknown_users(sharded_app):
+    response = sharded_app.test_client().get('/api/assessments/424242')
+
+    assert response.status_code == 404
+    assert UserShard.query.count() == 0
+    with pytest.raises(ValueError):
+        get_shard_router().assign_shard(424242)
+
+
+def test_move_user_copies_rows_and_updates_directory(sharded_app):
+    router = get_shard_router()
+    user_id = create_user()
+    source_shard = router.assign_shard(user_id)
+    target_shard = 1 - source_shard
+    add_rows(router.session_for_shard(source_shard), user_id)
+
+    assert router.move_user(user_id, target_shard) == 2
+
+    assert router.shard_for_user(user_id) == target_shard
+    assert count_rows(router.session_for_shard(target_shard), user_id) == 2
+    assert count_rows(router.session_for_shard(source_shard), user_id) == 0
+
+
+def test_move_user_rerun_finishes_interrupted_cleanup(sharded_app):
+    router = get_shard_router()
+    user_id = create_user()
+    source_shard = router.assign_shard(user_id)
+    target_shard = 1 - source_shard
+
+    # State after a move whose final delete failed: rows on both shards, directory updated
+    add_rows(router.session_for_shard(source_shard), user_id)
+    add_rows(router.session_for_shard(target_shard), user_id)
+    db.session.merge(UserShard(user_id=user_id, shard=target_shard))
+    db.session.commit()
+
+    assert router.move_user(user_id, target_shard) == 0
+
+    assert count_rows(router.session_for_shard(target_shard), user_id) == 2
+    assert count_rows(router.session_for_shard(source_shard), user_id) == 0
+
+
+def test_routes_reject_non_numeric_user_id(sharded_app):
+    client = sharded_app.test_client()
+
+    response = client.post('/api/journal', json={'user_id': 'abc', 'entry': 'entry'})
+
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'User ID must be a positive integer'}
+
+
+def test_move_user_command_requires_sharding(app):
+    result = app.test_cli_runner().invoke(args=['shards', 'move-user', '1', '0'])
+
+    assert result.exit_code == 1
+    assert 'requires SHARD_URIS' in result.output
+
+
+def test_import_default_moves_rows_and_unblocks_routing(sharded_app):
+    router = get_shard_router()
+    user_id = create_user()
+    add_rows(db.session, user_id)
+    client = sharded_app.test_client()
+
+    # Rows in the default database would be hidden, so routing is refused until imported
+    assert client.get(f'/api/assessments/{user_id}').status_code == 500
+
+    result = sharded_app.test_cli_runner().invoke(args=['shards', 'import-default'])
+
+    assert 'Moved 2 rows for 1 users' in result.output
+    assert not router.default_has_rows()
+    assert count_rows(router.session_for_shard(router.shard_for_user(user_id)), user_id) == 2
+    assert db.session.get(UserShard, user_id) is not None
+    assert len(client.get(f'/api/assessments/{user_id}').get_json()['assessments']) == 1
+
+
+def test_production_boot_reports_missing_shard_columns(sharded_app):
+    router = get_shard_router()
+    with db.engines['shard_1'].begin() as connection:
+        connection.execute(text('ALTER TABLE mood_log DROP COLUMN note'))
+
+    assert router.schema_problems() == ['shard_1.mood_log is missing note']
+    with pytest.raises(RuntimeError, match='shard_1.mood_log is missing note'):
+        router.check_tables()